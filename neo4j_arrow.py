@@ -1,10 +1,19 @@
-from typing import Any, Dict, Iterable, Union, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Union, Tuple
 from enum import Enum
-import json
+import contextlib, hashlib, itertools, json, threading
 
 import pyarrow as pa
 import pyarrow.flight as flight
 
+# orjson is optional: it's faster and works in bytes, but stdlib json will do
+try:
+    import orjson
+    _dumps, _loads = orjson.dumps, orjson.loads
+except ImportError:
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+    _loads = json.loads
+
 
 class ClientState(Enum):
     READY = "ready"
@@ -14,57 +23,201 @@ class ClientState(Enum):
     GRAPH_READY = "done"
 
 
+# Auth headers per (host, port, user, password hash), shared by every client
+# in this process. Entries get dropped when the server rejects them.
+_AUTH_CACHE: Dict[Tuple[str, int, str, str], Tuple[bytes, bytes]] = {}
+_AUTH_LOCK = threading.Lock()
+
+
+class WriterSession():
+    """
+    A do_put writer kept open across many batches (and tables), so streaming
+    from many sources pays for a single put. A put carries a single schema, so
+    a batch with a different schema closes the current writer and opens a
+    new one.
+    """
+    def __init__(self, client: "Neo4jArrowClient", descriptor: flight.FlightDescriptor):
+        self.client = client
+        self.descriptor = descriptor
+        self.writer = None
+        self.schema = None
+        self.rows, self.nbytes = 0, 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _writer_for(self, schema: pa.Schema):
+        if self.writer is not None and not self.schema.equals(schema):
+            self.writer.close()
+            self.writer = None
+        if self.writer is None:
+            flight_client = self.client._next_client()
+            with self.client._auth_guard():
+                self.writer, _ = flight_client.do_put(self.descriptor, schema,
+                                                      options=self.client.call_opts)
+            self.schema = schema
+        return self.writer
+
+    def write_batch(self, batch: pa.RecordBatch):
+        writer = self._writer_for(batch.schema)
+        with self.client._auth_guard():
+            writer.write_batch(batch)
+        self.rows += batch.num_rows
+        self.nbytes += batch.nbytes
+
+    def write_table(self, table: pa.Table):
+        writer = self._writer_for(table.schema)
+        with self.client._auth_guard():
+            writer.write_table(table)
+        self.rows += table.num_rows
+        self.nbytes += table.nbytes
+
+    def write_batches(self, batches: Iterable[pa.RecordBatch]) -> Tuple[int, int]:
+        """Write all the given batches, returning the rows/bytes they added."""
+        rows, nbytes = self.rows, self.nbytes
+        for batch in batches:
+            self.write_batch(batch)
+        return self.rows - rows, self.nbytes - nbytes
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
 class Neo4jArrowClient():
     def __init__(self, host: str, *, port: int=8491, user: str = "neo4j",
                  password: str = "neo4j", graph: str = "gcdemo", tls: bool = True,
-                 concurrency: int = 4, database: str = "neo4j"):
+                 concurrency: int = 4, database: str = "neo4j", pool_size: int = 4,
+                 compression: Optional[str] = None):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.tls = tls
-        self.client: flight.FlightClient = None
+        self.pool_size = max(1, pool_size)
+        self.compression = compression
+        self._clients: List[flight.FlightClient] = []
+        self._rr = itertools.count()
         self.call_opts = None
         self.graph = graph
         self.database = database
         self.concurrency = concurrency
         self.state = ClientState.READY
+        self._tickets: Dict[Tuple, flight.Ticket] = {}
+        self._build_descriptors()
+
+    def _build_descriptors(self):
+        """The put descriptors never change for a given graph, so build them once."""
+        self._node_desc = flight.FlightDescriptor.for_command(
+            _dumps({ "name": self.graph, "entity_type": "node" })
+        )
+        self._edge_desc = flight.FlightDescriptor.for_command(
+            _dumps({ "name": self.graph, "entity_type": "relationship" })
+        )
 
     def __str__(self):
         return f"Neo4jArrowClient{{{self.user}@{self.host}:{self.port}/{self.graph}}}"
 
     def __getstate__(self):
         state = self.__dict__.copy()
-        # Remove the FlightClient and CallOpts as they're not serializable
-        if "client" in state:
-            del state["client"]
+        # Remove the FlightClients and CallOpts as they're not serializable
+        state["_clients"] = []
+        state.pop("_rr", None)
+        state.pop("_node_desc", None)
+        state.pop("_edge_desc", None)
+        state.pop("_tickets", None)
         if "call_opts" in state:
             del state["call_opts"]
         return state
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._rr = itertools.count()
+        self.call_opts = None
+        self._tickets = {}
+        self._build_descriptors()
+
     def copy(self):
-        client = Neo4jArrowClient(self.host, port=self.port, user=self.user,
-                                  password=self.password, graph=self.graph,
-                                  tls=self.tls, concurrency=self.concurrency,
-                                  database=self.database)
-        client.state = self.state
+        return Neo4jArrowClient.from_config(self.to_config())
+
+    def to_config(self) -> Dict[str, Any]:
+        """Plain dict of the client settings, safe for msgpack/json."""
+        return {
+            "host": self.host, "port": self.port, "user": self.user,
+            "password": self.password, "graph": self.graph, "tls": self.tls,
+            "concurrency": self.concurrency, "database": self.database,
+            "pool_size": self.pool_size, "compression": self.compression,
+            "state": self.state.value,
+        }
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]):
+        """Inverse of to_config()."""
+        config = dict(config)
+        state = ClientState(config.pop("state", ClientState.READY.value))
+        host = config.pop("host")
+        client = cls(host, **config)
+        client.state = state
         return client
 
     def _client(self):
-        """Lazy client construction to help pickle this class."""
-        if not hasattr(self, "client") or not self.client:
+        """
+        Lazy client construction to help pickle this class. Builds a pool of
+        FlightClients, each with its own connection, so concurrent puts/gets
+        don't all contend for a single HTTP/2 connection.
+        """
+        if not self._clients:
             self.call_opts = None
             if self.tls:
                 location = flight.Location.for_grpc_tls(self.host, self.port)
             else:
                 location = flight.Location.for_grpc_tcp(self.host, self.port)
-            client = flight.FlightClient(location)
+            clients = [flight.FlightClient(location) for _ in range(self.pool_size)]
+            headers = []
             if self.user and self.password:
-                (header, token) = client.authenticate_basic_token(self.user, self.password)
+                key = self._auth_key()
+                with _AUTH_LOCK: # worker threads all connect at once on startup
+                    if key not in _AUTH_CACHE:
+                        _AUTH_CACHE[key] = clients[0].authenticate_basic_token(self.user, self.password)
+                    (header, token) = _AUTH_CACHE[key]
                 if header:
-                    self.call_opts = flight.FlightCallOptions(headers=[(header, token)])
-            self.client = client
-        return self.client
+                    headers.append((header, token))
+            # Optional IPC-level buffer compression (e.g. "lz4_frame") for our puts
+            write_options = pa.ipc.IpcWriteOptions(compression=self.compression)
+            self.call_opts = flight.FlightCallOptions(headers=headers,
+                                                      write_options=write_options)
+            self._clients = clients
+        return self._clients[0]
+
+    def _auth_key(self) -> Tuple[str, int, str, str]:
+        digest = hashlib.sha256(self.password.encode("utf-8")).hexdigest()
+        return (self.host, self.port, self.user, digest)
+
+    def _forget_auth(self):
+        """Drop our cached auth header and clients so the next call re-auths."""
+        if self.user and self.password:
+            with _AUTH_LOCK:
+                _AUTH_CACHE.pop(self._auth_key(), None)
+        self._clients = []
+        self.call_opts = None
+
+    @contextlib.contextmanager
+    def _auth_guard(self):
+        """Forget our auth if the server rejects it, then re-raise."""
+        try:
+            yield
+        except flight.FlightUnauthenticatedError:
+            self._forget_auth()
+            raise
+
+    def _next_client(self):
+        """Round-robin over our pool of FlightClients."""
+        self._client()
+        return self._clients[next(self._rr) % len(self._clients)]
         
     def _send_action(self, action: str, body: Dict[str, Any]) -> dict:
         """
@@ -72,65 +225,72 @@ class Neo4jArrowClient():
         """
         client = self._client()
         try:
-            payload = json.dumps(body).encode("utf-8")
-            result = client.do_action(
-                flight.Action(action, payload),
-                options=self.call_opts
-            )
-            return json.loads(next(result).body.to_pybytes().decode())
+            with self._auth_guard():
+                payload = _dumps(body)
+                result = client.do_action(
+                    flight.Action(action, payload),
+                    options=self.call_opts
+                )
+                return _loads(next(result).body.to_pybytes())
         except Exception as e:
             print(f"send_action error: {e}")
             #return None
             raise e
 
 
-    def _write_table(self, desc: bytes, table: pa.Table) -> Tuple[int, int]:
+    def _write_table(self, upload_descriptor: flight.FlightDescriptor,
+                     table: pa.Table, mappingfn = None) -> Tuple[int, int]:
         """
-        Write a PyArrow Table to the GDS Flight service.
+        Write a PyArrow Table to the GDS Flight service. The optional mappingfn
+        is applied once to the whole Table (e.g. a single rename_columns).
         """
-        client = self._client()
-        upload_descriptor = flight.FlightDescriptor.for_command(
-            json.dumps(desc).encode("utf-8")
-        )
-        writer, _ = client.do_put(upload_descriptor, table.schema, options=self.call_opts)
+        if mappingfn:
+            table = mappingfn(table)
+        client = self._next_client()
+        with self._auth_guard():
+            writer, _ = client.do_put(upload_descriptor, table.schema, options=self.call_opts)
         with writer:
             try:
-                writer.write_table(table)
-                return table.num_rows, table.get_total_buffer_size()
+                with self._auth_guard():
+                    writer.write_table(table)
+                return table.num_rows, table.nbytes
             except Exception as e:
                 print(f"_write_table error: {e}")
         return 0, 0
 
-    @classmethod
-    def _nop(*args, **kwargs):
-        pass
+    @staticmethod
+    def _identity(batch):
+        return batch
 
-    def _write_batches(self, desc: bytes, batches, mappingfn = None) -> Tuple[int, int]:
+    def _write_batches(self, upload_descriptor: flight.FlightDescriptor,
+                       batches, mappingfn = None) -> Tuple[int, int]:
         """
-        Write PyArrow RecordBatches to the GDS Flight service.
+        Write PyArrow RecordBatches to the GDS Flight service. The target schema
+        comes from the first (mapped) batch and the rest of the stream is
+        wrapped in a RecordBatchReader bound to that schema.
         """
         batches = iter(batches)
-        fn = mappingfn or self._nop
+        fn = mappingfn or self._identity
 
-        first = fn(next(batches, None))
-        if not first:
+        first = next(batches, None)
+        if first is None:
             raise Exception("empty iterable of record batches provided")
-        
-        client = self._client()
-        upload_descriptor = flight.FlightDescriptor.for_command(
-            json.dumps(desc).encode("utf-8")
+        first = fn(first)
+        reader = pa.RecordBatchReader.from_batches(
+            first.schema, itertools.chain([first], map(fn, batches))
         )
+        
+        client = self._next_client()
         rows, nbytes = 0, 0
-        writer, _ = client.do_put(upload_descriptor, first.schema, options=self.call_opts)
+        with self._auth_guard():
+            writer, _ = client.do_put(upload_descriptor, reader.schema, options=self.call_opts)
         with writer:
             try:
-                writer.write_batch(first)
-                rows += first.num_rows
-                nbytes += first.get_total_buffer_size()
-                for remaining in batches:
-                    writer.write_batch(fn(remaining))
-                    rows += remaining.num_rows
-                    nbytes += remaining.get_total_buffer_size()
+                with self._auth_guard():
+                    for batch in reader:
+                        writer.write_batch(batch)
+                        rows += batch.num_rows
+                        nbytes += batch.nbytes
             except Exception as e:
                 print(f"_write_batches error: {e}")
         return rows, nbytes
@@ -150,10 +310,15 @@ class Neo4jArrowClient():
 
     def write_nodes(self, nodes: Union[pa.Table, Iterable[pa.RecordBatch]], mappingfn = None) -> Tuple[int, int]:
         assert self.state == ClientState.FEEDING_NODES
-        desc = { "name": self.graph, "entity_type": "node" }
         if isinstance(nodes, pa.Table):
-            return self._write_table(desc, nodes, mappingfn)
-        return self._write_batches(desc, nodes, mappingfn)
+            return self._write_table(self._node_desc, nodes, mappingfn)
+        return self._write_batches(self._node_desc, nodes, mappingfn)
+
+    def open_nodes(self) -> WriterSession:
+        """Open a WriterSession for streaming nodes over a single put."""
+        assert self.state == ClientState.FEEDING_NODES
+        self._client()
+        return WriterSession(self, self._node_desc)
 
     def nodes_done(self) -> Dict[str, Any]:
         assert self.state == ClientState.FEEDING_NODES
@@ -164,10 +329,15 @@ class Neo4jArrowClient():
 
     def write_edges(self, edges: Union[pa.Table, Iterable[pa.RecordBatch]], mappingfn = None) -> Tuple[int, int]:
         assert self.state == ClientState.FEEDING_EDGES
-        desc = { "name": self.graph, "entity_type": "relationship" }
         if isinstance(edges, pa.Table):
-            return self._write_table(desc, edges, mappingfn)
-        return self._write_batches(desc, edges, mappingfn)
+            return self._write_table(self._edge_desc, edges, mappingfn)
+        return self._write_batches(self._edge_desc, edges, mappingfn)
+
+    def open_edges(self) -> WriterSession:
+        """Open a WriterSession for streaming edges over a single put."""
+        assert self.state == ClientState.FEEDING_EDGES
+        self._client()
+        return WriterSession(self, self._edge_desc)
 
     def edges_done(self) -> Dict[str, Any]:
         assert self.state == ClientState.FEEDING_EDGES
@@ -177,43 +347,41 @@ class Neo4jArrowClient():
             self.state = ClientState.AWAITING_GRAPH
         return result
 
-    def read_edges(self, prop: str):
+    def _build_ticket(self, procedure: str, prop: str, concurrency: int) -> flight.Ticket:
+        """Build (and cache) the do_get Ticket for streaming a graph property."""
+        key = (self.graph, self.database, procedure, prop, concurrency)
+        if key in self._tickets:
+            return self._tickets[key]
+        if procedure == "gds.graph.streamNodeProperty":
+            configuration = { "node_labels": "*", "node_property": prop }
+        else:
+            configuration = { "relationship_types": "*", "relationship_property": prop }
         ticket = {
             "graph_name": self.graph, "database_name": self.database,
-            "procedure_name": "gds.graph.streamRelationshipProperty",
-            "configuration": {
-                "relationship_types": "*", 
-                "relationship_property": prop,
-            },
-            "concurrency": 224,
+            "procedure_name": procedure,
+            "configuration": configuration,
+            "concurrency": concurrency,
         }
+        self._tickets[key] = flight.Ticket(_dumps(ticket))
+        return self._tickets[key]
 
-        client = self._client()
-        result = client.do_get(
-            pa.flight.Ticket(json.dumps(ticket).encode("utf8")),
-            options=self.call_opts
-        )
-        for chunk, _ in result:
-            yield chunk
-
-    def read_nodes(self, prop: str):
-        ticket = {
-            "graph_name": self.graph, "database_name": self.database,
-            "procedure_name": "gds.graph.streamNodeProperty",
-            "configuration": { 
-                "node_labels": "*", 
-                "node_property": prop,
-            },
-            "concurrency": 224,
-        }
+    def read_edges(self, prop: str, *, concurrency: Optional[int] = None):
+        ticket = self._build_ticket("gds.graph.streamRelationshipProperty", prop,
+                                    concurrency or self.concurrency)
+        client = self._next_client()
+        with self._auth_guard():
+            result = client.do_get(ticket, options=self.call_opts)
+            for chunk, _ in result:
+                yield chunk
 
-        client = self._client()
-        result = client.do_get(
-            pa.flight.Ticket(json.dumps(ticket).encode("utf8")),
-            options=self.call_opts
-        )
-        for chunk, _ in result:
-            yield chunk
+    def read_nodes(self, prop: str, *, concurrency: Optional[int] = None):
+        ticket = self._build_ticket("gds.graph.streamNodeProperty", prop,
+                                    concurrency or self.concurrency)
+        client = self._next_client()
+        with self._auth_guard():
+            result = client.do_get(ticket, options=self.call_opts)
+            for chunk, _ in result:
+                yield chunk
 
 
     def wait(timeout: int = 0):
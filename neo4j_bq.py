@@ -1,15 +1,40 @@
-from typing import Any, Callable, Dict, List, Union, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Union, Tuple
 
-import base64, pickle, os, sys, time
+import contextlib, itertools, os, queue, signal, sys, threading, time
 import multiprocessing as mp
 import subprocess as sub
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from google.cloud.bigquery_storage import BigQueryReadClient, types
+import msgpack
 
 import pyarrow as pa
+import pyarrow.compute as pc
 import neo4j_arrow as na
 
 
+# Up to this many workers, use threads instead of forking processes. Our
+# workers mostly wait on gRPC I/O, which releases the GIL.
+MAX_THREADS = 32
+
+# How many chunks of tasks to hand each worker, trading fewer Flight puts
+# against balancing the load across workers
+CHUNKS_PER_WORKER = 4
+
+# Number of RecordBatches to read ahead of the Flight writer per stream
+PREFETCH_BATCHES = 4
+
+# Batch sizing sweet spot (rows and bytes) for what we send over Flight
+TARGET_BATCH_ROWS = 8_192
+TARGET_BATCH_BYTES = 256 * 1024
+_EOF = object()
+
+# Schema of the per-worker results our child process streams back to fan_out
+RESULT_SCHEMA = pa.schema([
+    ("name", pa.string()), ("rows", pa.int64()), ("bytes", pa.int64()),
+])
+
+
 class BigQuerySource:
     """
     Wrapper around a BigQuery Dataset. Uses the Storage API to generate a list
@@ -28,7 +53,13 @@ class BigQuerySource:
         _client = BigQueryReadClient()
         read_session = types.ReadSession(
             table=f"projects/{self.project_id}/datasets/{self.dataset}/tables/{table}",
-            data_format=types.DataFormat.ARROW
+            data_format=types.DataFormat.ARROW,
+            read_options=types.ReadSession.TableReadOptions(
+                # compressed on the wire, PyArrow decompresses transparently
+                arrow_serialization_options=types.ArrowSerializationOptions(
+                    buffer_compression=types.ArrowSerializationOptions.CompressionCodec.LZ4_FRAME
+                )
+            ),
         )
         if fields:
             read_session.read_options.selected_fields=fields
@@ -43,97 +74,306 @@ class BigQuerySource:
 
 def streams_from(node_or_edge: Dict[str, Any]) -> List[Dict[str, Any]]:
     """Transform a node/edge dict into a list of single-stream work units."""
-    streams = []
-    for stream in node_or_edge.get("streams"):
-        d = dict(
-            [("stream", stream)] + 
-            [(k, v) for k, v in node_or_edge.items() if not k == "streams"]
-        )
-        streams.append(d)
-    return streams
+    base = {k: v for k, v in node_or_edge.items() if k != "streams"}
+    return [{**base, "stream": stream} for stream in node_or_edge["streams"]]
+
+
+def _rename_schema(schema: pa.Schema, mapping: Dict[str, str]) -> pa.Schema:
+    """Rename the fields of a Schema in a single pass, building one new Schema."""
+    return pa.schema([f.with_name(mapping.get(f.name, f.name)) for f in schema],
+                     metadata=schema.metadata)
+
+
+def _renamer(rename: Dict[str, str]) -> Callable:
+    """
+    Build a mapping function that renames the columns of a RecordBatch (or
+    Table) using rename_columns (zero-copy). Schemas are stable within a
+    stream, so the renamed schema gets computed once per schema and not once
+    per batch. Batches needing no renaming get passed through untouched.
+    """
+    rename = {k: v for k, v in rename.items() if k is not None and k != v}
+    # (last_schema, new_schema): every batch has its own Schema wrapper, so
+    # compare by value rather than by identity
+    last = [None, None]
+    def map_batch(batch):
+        if not rename:
+            return batch
+        schema = batch.schema
+        if last[0] is None or not last[0].equals(schema):
+            if any(name in rename for name in schema.names):
+                last[1] = _rename_schema(schema, rename)
+            else:
+                last[1] = None
+            last[0] = schema
+        new_schema = last[1]
+        if new_schema is None:
+            return batch
+        if hasattr(batch, "rename_columns"):
+            return batch.rename_columns(new_schema.names)
+        # RecordBatch.rename_columns needs pyarrow >= 16
+        return pa.RecordBatch.from_arrays(batch.columns, schema=new_schema)
+    return map_batch
+
+
+def _recoder(remap: Optional[Dict[str, Tuple[List[Any], List[Any]]]]) -> Callable:
+    """
+    Build a mapping function that recodes id values in the named columns of a
+    RecordBatch, given (old_ids, new_ids) pairs per column. The lookup runs in
+    Arrow compute kernels, never touching Python objects per row. Integer id
+    columns keep their values when unmapped (and their width when new_ids
+    fit); any other change of type (e.g. string to int) leaves unmapped
+    values null.
+    """
+    int_types = [pa.int8(), pa.int16(), pa.int32(), pa.int64(),
+                  pa.uint8(), pa.uint16(), pa.uint32(), pa.uint64()]
+
+    # {column: {value type: (old_ids, new_ids)}}, built up front so integer id
+    # columns of any width find matching lookups without mutating shared state
+    lookups = {}
+    for column, (old_ids, new_ids) in (remap or {}).items():
+        old_ids, new_ids = pa.array(old_ids), pa.array(new_ids)
+        by_type = { old_ids.type: (old_ids, new_ids) }
+        if pa.types.is_integer(old_ids.type):
+            for int_type in int_types:
+                if int_type in by_type:
+                    continue
+                try:
+                    old_cast = old_ids.cast(int_type)
+                except pa.ArrowInvalid:
+                    continue # ids don't fit this width, so can't be in such a column
+                try:
+                    new_cast = new_ids.cast(int_type) if pa.types.is_integer(new_ids.type) else new_ids
+                except pa.ArrowInvalid:
+                    new_cast = new_ids # keep the wider type, widen the column instead
+                by_type[int_type] = (old_cast, new_cast)
+        lookups[column] = by_type
+
+    def map_batch(batch):
+        if not lookups:
+            return batch
+        schema, columns = batch.schema, batch.columns
+        for column, by_type in lookups.items():
+            idx = schema.get_field_index(column)
+            if idx < 0:
+                continue
+            values = columns[idx]
+            if values.type not in by_type:
+                raise TypeError(f"can't remap column {column} of type {values.type} "
+                                f"using ids of type {next(iter(by_type))}")
+            old_ids, new_ids = by_type[values.type]
+            positions = pc.index_in(values, value_set=old_ids)
+            recoded = pc.take(new_ids, positions)
+            if new_ids.type == values.type:
+                recoded = pc.coalesce(recoded, values)
+            elif pa.types.is_integer(new_ids.type) and pa.types.is_integer(values.type):
+                recoded = pc.coalesce(recoded, values.cast(new_ids.type))
+            columns[idx] = recoded
+            schema = schema.set(idx, schema.field(idx).with_type(new_ids.type))
+        return pa.RecordBatch.from_arrays(columns, schema=schema)
+    return map_batch
+
+
+def coalesce(batches: Iterable[pa.RecordBatch], target_rows: int = TARGET_BATCH_ROWS,
+             target_bytes: int = TARGET_BATCH_BYTES) -> Iterator[pa.RecordBatch]:
+    """
+    Re-chunk a stream of RecordBatches so each yielded batch is close to the
+    target row count/byte budget: small batches get merged and oversized
+    batches get (zero-copy) sliced.
+    """
+    buf, buf_rows, buf_bytes = [], 0, 0
+
+    def flush():
+        if len(buf) == 1:
+            yield buf[0]
+        elif buf:
+            # buf never exceeds our targets, so this is a single batch
+            yield from pa.Table.from_batches(buf).combine_chunks().to_batches()
+        buf.clear()
+
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        if batch.num_rows > target_rows or batch.nbytes > target_bytes:
+            yield from flush()
+            buf_rows, buf_bytes = 0, 0
+            row_bytes = max(1, batch.nbytes // batch.num_rows)
+            step = max(1, min(target_rows, target_bytes // row_bytes))
+            for offset in range(0, batch.num_rows, step):
+                yield batch.slice(offset, step)
+            continue
+        # flush first if this batch would push us past a target, so merging
+        # never leaves small leftover fragments behind
+        if (buf_rows + batch.num_rows > target_rows
+                or buf_bytes + batch.nbytes > target_bytes):
+            yield from flush()
+            buf_rows, buf_bytes = 0, 0
+        buf.append(batch)
+        buf_rows += batch.num_rows
+        buf_bytes += batch.nbytes
+    yield from flush()
 
 
 _worker_na_client = None
-def _initializer(client: na.Neo4jArrowClient):
-    """Initializer for our multiprocessing Pool members."""
-    global _worker_na_client
+_worker_bq_client = None
+_worker_recode = _recoder(None)
+_worker_local = threading.local()
+def _initializer(client: na.Neo4jArrowClient, remap: Optional[Dict[str, Any]] = None):
+    """Initializer for our multiprocessing Pool members (or thread pool)."""
+    global _worker_na_client, _worker_bq_client, _worker_recode
     _worker_na_client = client
+    _worker_bq_client = BigQueryReadClient()
+    _worker_recode = _recoder(remap)
 
 
-def _process_nodes(nodes, **kwargs) -> Tuple[int, int]:
-    """Streams the given PyArrow table to the Neo4j server using a Neo4jArrowClient."""
-    global _worker_na_client
-    assert _worker_na_client
-    
+def _available_cpus() -> int:
+    """CPUs we're allowed to run on (respects cgroups/affinity masks on Linux)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return mp.cpu_count()
+
+
+def _pinned_initializer(client: na.Neo4jArrowClient, remap: Optional[Dict[str, Any]] = None):
+    """Initializer for forked Pool members that also pins each to one CPU."""
+    try:
+        cpus = sorted(os.sched_getaffinity(0))
+        # every Pool member inherits the same environment, so WORKER_ID can
+        # only offset the Pool index, not replace it
+        offset = int(os.environ.get("WORKER_ID", 0))
+        worker_id = offset + mp.current_process()._identity[0] - 1
+        os.sched_setaffinity(0, {cpus[worker_id % len(cpus)]})
+    except (AttributeError, IndexError):
+        pass # not on Linux or not a Pool member
+    _initializer(client, remap)
+
+
+def _worker_client() -> na.Neo4jArrowClient:
+    """
+    Lazily give each worker thread its own connected Neo4jArrowClient. A worker
+    only issues one put at a time, so it gets a single connection rather than
+    a pool it would handshake with but never use concurrently.
+    """
+    client = getattr(_worker_local, "na_client", None)
+    if client is None:
+        config = _worker_na_client.to_config()
+        config["pool_size"] = 1
+        client = na.Neo4jArrowClient.from_config(config)
+        client._client()
+        _worker_local.na_client = client
+    return client
+
+
+def _process_nodes(nodes, session: na.WriterSession, **kwargs) -> Tuple[int, int]:
+    """Streams the given RecordBatches to the Neo4j server via a WriterSession."""
     # Perform last mile renaming of any fields in our PyArrow Table
     key, labels = kwargs.get("key"), kwargs.get("labels")
-    def map_batch(batch):
-        new_schema = batch.schema
-        for idx, name in enumerate(batch.schema.names): # assumption: they're in the column order
-            field = new_schema.field(name)
-            if name == key:
-                new_schema = new_schema.set(idx, field.with_name("nodeId"))
-            elif name == labels:
-                new_schema = new_schema.set(idx, field.with_name("labels"))
-        return batch.from_arrays(batch.columns, schema=new_schema)
+    rename = {key: "nodeId", labels: "labels"}
+    map_batch = _renamer(rename)
     
     # feed the graph
-    return _worker_na_client.write_nodes(nodes, map_batch)
+    return session.write_batches(map(map_batch, map(_worker_recode, nodes)))
 
 
-def _process_edges(edges, **kwargs) -> Tuple[int, int]:
-    """Streams the given PyArrow table to the Neo4j server using a Neo4jArrowClient."""
-    global _worker_na_client
-    assert _worker_na_client
-    
+def _process_edges(edges, session: na.WriterSession, **kwargs) -> Tuple[int, int]:
+    """Streams the given RecordBatches to the Neo4j server via a WriterSession."""
     # Perform last mile renaming of any fields in our PyArrow Table/Recordbatch
     src, dst, _type = kwargs.get("src"), kwargs.get("dst"), kwargs.get("type")
-    def map_batch(batch):
-        new_schema = batch.schema
-        for idx, name in enumerate(batch.schema.names): # assumption: they're in the column order
-            field = new_schema.field(name)
-            if name == src:
-                new_schema = new_schema.set(idx, field.with_name("sourceNodeId"))
-            elif name == dst:
-                new_schema = new_schema.set(idx, field.with_name("targetNodeId"))
-            elif name == _type:
-                new_schema = new_schema.set(idx, field.with_name("relationshipType"))
-        return batch.from_arrays(batch.columns, schema=new_schema)
+    rename = {src: "sourceNodeId", dst: "targetNodeId", _type: "relationshipType"}
+    map_batch = _renamer(rename)
     
     # feed the graph
-    return _worker_na_client.write_edges(edges, map_batch)
+    return session.write_batches(map(map_batch, map(_worker_recode, edges)))
+
+
+def prefetch(batches: Iterable[pa.RecordBatch],
+             size: int = PREFETCH_BATCHES) -> Iterator[pa.RecordBatch]:
+    """
+    Pull batches from the given iterable on a background thread, keeping at
+    most size of them queued, so reading the next batch (e.g. from BigQuery)
+    overlaps with writing the current one to Neo4j.
+    """
+    q = queue.Queue(maxsize=size)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        """Queue an item, giving up if our consumer went away."""
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill():
+        try:
+            for batch in batches:
+                if not put(batch):
+                    break
+            else:
+                put(_EOF)
+        except Exception as e:
+            put(e)
+        finally:
+            # release the underlying (e.g. BigQuery) stream if we stopped early
+            close = getattr(batches, "close", None)
+            if close:
+                close()
+    threading.Thread(target=fill, daemon=True).start()
+
+    try:
+        while True:
+            batch = q.get()
+            if batch is _EOF:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stop.set()
+
+
+def stream_batches(stream: str) -> Iterator[pa.RecordBatch]:
+    """Yield the Arrow RecordBatches of a single BigQuery Storage stream."""
+    rows = _worker_bq_client.read_rows(stream).rows()
+    for page in rows.pages:
+        yield page.to_arrow()
 
 
 def worker(work: Union[Dict[str, Any], List[Dict[str, Any]]]) -> Dict[str, Any]:
     """Main logic for our subprocessing children"""
-    client = BigQueryReadClient()
+    assert _worker_bq_client
     
-    name = f"worker-{os.getpid()}"
+    name = f"worker-{os.getpid()}-{threading.get_native_id()}"
     if isinstance(work, dict):
         work = [work]
     
-    def consume_stream(consumer, **kwargs):
-        """Apply consumer to a stream in the form of a generator"""
-        stream = kwargs["stream"]
-        reader = client.read_rows(stream)
-        rows = reader.rows()
-        
-        def batch_generator():
-            for page in rows.pages:
-                yield page.to_arrow()
-        yield consumer(batch_generator(), **kwargs)
-
     total_rows, total_bytes = 0, 0    
     
-    # For now, we identify the work type based on its schema
-    for task in work:
-        if "key" in task:
-            fn = _process_nodes
-        elif "src" in task:
-            fn = _process_edges
-        else:
-            raise Exception(f"{name} can't pick a consuming function")
-        for rows, nbytes in consume_stream(fn, **task):
+    # One writer session per kind of work, shared by all the streams we handle
+    client = _worker_client()
+    with contextlib.ExitStack() as stack:
+        sessions = {}
+        def session_for(kind):
+            if kind not in sessions:
+                if kind == "nodes":
+                    sessions[kind] = stack.enter_context(client.open_nodes())
+                else:
+                    sessions[kind] = stack.enter_context(client.open_edges())
+            return sessions[kind]
+
+        # For now, we identify the work type based on its schema
+        for task in work:
+            if "key" in task:
+                fn, kind = _process_nodes, "nodes"
+            elif "src" in task:
+                fn, kind = _process_edges, "edges"
+            else:
+                raise Exception(f"{name} can't pick a consuming function")
+            # BigQuery reads run ahead on prefetch()'s thread while this thread
+            # blocks in the Flight writer, so reads and writes already overlap.
+            batches = prefetch(coalesce(stream_batches(task["stream"])))
+            rows, nbytes = fn(batches, session_for(kind), **task)
             total_rows += rows
             total_bytes += nbytes
     return {"name": name, "rows": total_rows, "bytes": total_bytes}
@@ -141,7 +381,7 @@ def worker(work: Union[Dict[str, Any], List[Dict[str, Any]]]) -> Dict[str, Any]:
 
 def flatten(lists: List[List[Any]], fn: Callable) -> List[Any]:
     """Helper function...collapse list of lists into a single list."""
-    return [x for y in map(fn, lists) for x in y]
+    return list(itertools.chain.from_iterable(map(fn, lists)))
 
 
 
@@ -167,30 +407,71 @@ def flatten(lists: List[List[Any]], fn: Callable) -> List[Any]:
 ###############################################################################
 
 def fan_out(client: na.Neo4jArrowClient, work: List[str],
-            processes: int = 0, timeout: int = 120) -> Tuple[List[Any], float]:
+            processes: int = 0, timeout: int = 120,
+            remap: Optional[Dict[str, Tuple[List[Any], List[Any]]]] = None) -> Tuple[List[Any], float]:
     """
     This is where the magic happens. Pop open a subprocess that execs this same
-    module. Once the child is alive, send it some pickled objects to bootstrap
+    module. Once the child is alive, send it a msgpack'd config to bootstrap
     the workload. The child will drive the worker pool and communicate back
-    data via stdout and messaging via stderr.
+    results as an Arrow IPC stream via stdout and messaging via stderr.
+    
+    An optional remap of {column: (old_ids, new_ids)} recodes id columns
+    before they're sent. It travels once in the config, not in every task.
+    
+    On timeout, the child is killed and any results received so far are
+    returned along with the elapsed time.
     
     This design solves problems with Jupyter kernels mismanaging children.
     """
-    config = { "processes": processes, "client": client.copy() }
-    #payload = base64.b64encode(pickle.dumps((config, work)))
-    payload = pickle.dumps((config, work))
+    config = { "processes": processes, "client": client.to_config(), "remap": remap }
+    payload = msgpack.packb({ "config": config, "work": work }, use_bin_type=True)
 
     argv = [sys.executable, "./neo4j_bq.py"]
-    with sub.Popen(argv, stdin=sub.PIPE, stdout=sub.PIPE) as proc:
+    # Own session/process group, so a timeout can take down forked pool
+    # workers too (they share our stdout pipe)
+    with sub.Popen(argv, stdin=sub.PIPE, stdout=sub.PIPE,
+                   start_new_session=True) as proc:
+        # Collect results on a reader thread as the child streams them, so
+        # whatever finished before a timeout isn't lost
+        res, delta, errors = [], [0.0], []
+        def read_results():
+            try:
+                reader = pa.ipc.open_stream(proc.stdout)
+                while True:
+                    try:
+                        batch, metadata = reader.read_next_batch_with_custom_metadata()
+                    except StopIteration:
+                        break
+                    res.extend(batch.to_pylist())
+                    if metadata and b"delta" in metadata:
+                        delta[0] = float(metadata[b"delta"])
+            except Exception as err:
+                errors.append(err)
+        reader_thread = threading.Thread(target=read_results, daemon=True)
+        reader_thread.start()
+
+        start = time.time()
         try:
-            (out, _) = proc.communicate(payload, timeout=timeout)
-            #(res, delta) = pickle.loads(base64.b64decode(out))
-            (res, delta) = pickle.loads(out)
-            return (res, delta)
-        except sub.TimeoutExpired as to_err:
+            proc.stdin.write(payload)
+            proc.stdin.close()
+        except BrokenPipeError:
+            # child died early; the reader will see EOF or an error
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        reader_thread.join(timeout)
+        if reader_thread.is_alive():
             print(f"timed out waiting for subprocess response...killing child")
-            proc.terminate()
-            return ([], 0)
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            reader_thread.join(5)
+            return (list(res), time.time() - start)
+        if errors:
+            raise errors[0]
+        return (res, delta[0])
         
 
 if __name__ == "__main__":
@@ -204,36 +485,67 @@ if __name__ == "__main__":
             sys.stderr.write(f"{msg}")
             sys.stderr.flush()
     
+    # Results go back to our parent as an Arrow IPC stream, one batch per result
+    out = pa.ipc.new_stream(sys.stdout.buffer, RESULT_SCHEMA)
     try:
-        # Read our payload from stdin and unpickle
-        (config, work) = pickle.load(sys.stdin.buffer)
+        # Read our payload from stdin
+        payload = msgpack.unpackb(sys.stdin.buffer.read(), raw=False)
+        config, work = payload["config"], payload["work"]
         
-        client = config["client"]
+        client = na.Neo4jArrowClient.from_config(config["client"])
         log(f"Using: 🚀 {client}")
 
-        processes = min(len(work), config.get("processes") or int(mp.cpu_count() * 1.3))
+        processes = min(len(work), config.get("processes") or _available_cpus())
         log(f"Spawning {processes:,} workers 🧑‍🏭 to process {len(work):,} tasks 📋")
         
+        # Hand out tasks in chunks so each worker call streams many BigQuery
+        # streams over the same Flight put
+        size = max(1, len(work) // (processes * CHUNKS_PER_WORKER))
+        work = [work[i:i + size] for i in range(0, len(work), size)]
+        
         # Make a pretty progress bar
-        ticks = [n for n in range(1, len(work), int(len(work) / 33))] + [len(work)]
+        ticks = [n for n in range(1, len(work), max(1, int(len(work) / 33)))] + [len(work)]
         ticks.reverse()
         
-        mp.set_start_method("fork")
-        with mp.Pool(processes=processes, initializer=_initializer,
-                    initargs=[client]) as pool:
+        remap = config.get("remap")
+        if processes <= MAX_THREADS:
+            _initializer(client, remap)
+            pool = ThreadPoolExecutor(max_workers=processes)
+            def run_threads():
+                # lazily submit so our timing starts with the processing loop
+                for future in as_completed([pool.submit(worker, w) for w in work]):
+                    yield future.result()
+            completed = run_threads()
+        else:
+            mp.set_start_method("fork")
+            pool = mp.Pool(processes=processes, initializer=_pinned_initializer,
+                           initargs=[client, remap])
+            completed = pool.imap_unordered(worker, work)
+        with pool:
             
             # The main processing loop
             log("⚙️ Loading: [", newline=False)
             start = time.time()
-            for result in pool.imap_unordered(worker, work):
-                results.append(result)
-                if ticks and len(results) == ticks[-1]:
-                    log("➶", newline=False)
-                    ticks.pop()
+            try:
+                for result in completed:
+                    results.append(result)
+                    out.write_batch(pa.RecordBatch.from_pylist([result], schema=RESULT_SCHEMA))
+                    sys.stdout.buffer.flush()
+                    if ticks and len(results) == ticks[-1]:
+                        log("➶", newline=False)
+                        ticks.pop()
+            except BaseException:
+                # Like mp.Pool's terminate(), don't run out the remaining tasks
+                if isinstance(pool, ThreadPoolExecutor):
+                    pool.shutdown(wait=False, cancel_futures=True)
+                raise
             log("]\n", newline=False) 
             delta = time.time() - start
         log(f"🏁 Completed in {round(delta, 2)}s")
     except Exception as e:
         log(f"⚠️ Error: {e}")
     
-    pickle.dump((results, delta), sys.stdout.buffer)
+    # Final empty batch carries our timing
+    out.write_batch(pa.RecordBatch.from_pylist([], schema=RESULT_SCHEMA),
+                    custom_metadata={"delta": str(delta)})
+    out.close()